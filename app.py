@@ -1,14 +1,25 @@
 import streamlit as st
 import os
 import json
+import orjson
 import base64
-import random
+import itertools
 import html as html_lib
 import re
+import string
+import shutil
+import tempfile
+import time
+import asyncio
+import hashlib
+from pathlib import Path
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from google import genai
 from google.genai import types
-import fitz  # PyMuPDF
-from PIL import Image
+from pydantic import BaseModel, Field, ValidationError, create_model
+# PyMuPDF, Pillow and NumPy are imported inside the functions that use them,
+# so the login screen of a cold process renders without paying their import cost.
 import io
 import streamlit.components.v1 as components
 
@@ -20,7 +31,8 @@ st.set_page_config(
 )
 
 # --- Custom CSS for Styling ---
-st.markdown("""
+# Streamlit rebuilds the page on every rerun, so the style block is emitted each time
+CSS = """
 <style>
     .report-header { background-color: #f0fdfa; padding: 20px; border-radius: 10px; border-bottom: 2px solid #e5e7eb; margin-bottom: 20px; }
     .report-title { color: #111827; font-family: 'Noto Serif JP', serif; font-weight: bold; font-size: 2em; }
@@ -30,46 +42,97 @@ st.markdown("""
     .figure-box { border: 1px solid #e5e7eb; border-radius: 8px; padding: 15px; margin-bottom: 20px; background-color: white; }
     .novelty-box { background-color: #eff6ff; padding: 15px; border-left: 5px solid #3b82f6; }
 </style>
-""", unsafe_allow_html=True)
+"""
+
+st.markdown(CSS, unsafe_allow_html=True)
 
 # --- Types & Schema ---
-ANALYSIS_SCHEMA = {
-    "type": "OBJECT",
-    "properties": {
-        "title_en": {"type": "STRING", "description": "The original English title."},
-        "title_jp": {"type": "STRING", "description": "Japanese translation of the title."},
-        "journal_authors": {"type": "STRING", "description": "Journal name and author list."},
-        "publication_year": {"type": "STRING", "description": "Year of publication."},
-        "background_objective": {"type": "STRING", "description": "Research background and objective in Japanese."},
-        "results_summary": {"type": "STRING", "description": "Comprehensive summary of results/discussion in Japanese. Must logically connect the experimental data."},
-        "results_figures": {
-            "type": "ARRAY",
-            "items": {
-                "type": "OBJECT",
-                "properties": {
-                    "label": {"type": "STRING", "description": "e.g., Figure 1"},
-                    "explanation": {"type": "STRING", "description": "Exhaustive Japanese explanation covering ALL discussions of this Figure/Table/Scheme in the paper. Include specific numerical values, comparison results, reaction conditions, and the authors' interpretations. Do NOT summarize briefly - translate the relevant paper text almost verbatim into Japanese."},
-                    "page_number": {"type": "INTEGER", "description": "1-based page number."},
-                    "bbox": {
-                        "type": "ARRAY",
-                        "items": {"type": "INTEGER"},
-                        "description": "[ymin, xmin, ymax, xmax] 0-1000 scale"
-                    }
-                },
-                "required": ["label", "explanation", "page_number", "bbox"]
-            }
-        },
-        "novelty": {"type": "STRING", "description": "Novelty and significance in Japanese."},
-        "conclusion_tasks": {"type": "STRING", "description": "Conclusion and future tasks in Japanese."}
-    },
-    "required": ["title_en", "title_jp", "journal_authors", "publication_year", "background_objective", "results_summary", "results_figures", "novelty", "conclusion_tasks"]
-}
+# Answered by the cheap metadata call; everything else comes from the deep call
+META_FIELDS = ("title_en", "title_jp", "journal_authors", "publication_year",
+               "background_objective", "novelty", "conclusion_tasks")
+
+class FigureOut(BaseModel):
+    label: str = Field(description="e.g., Figure 1")
+    explanation: str = Field(description="Exhaustive Japanese explanation covering ALL discussions of this Figure/Table/Scheme in the paper. Include specific numerical values, comparison results, reaction conditions, and the authors' interpretations. Do NOT summarize briefly - translate the relevant paper text almost verbatim into Japanese.")
+    page_number: int = Field(description="1-based page number.")
+    bbox: list[int] = Field(description="[ymin, xmin, ymax, xmax] 0-1000 scale", min_length=4, max_length=4)
+
+class AnalysisOut(BaseModel):
+    title_en: str = Field(description="The original English title.")
+    title_jp: str = Field(description="Japanese translation of the title.")
+    journal_authors: str = Field(description="Journal name and author list.")
+    publication_year: str = Field(description="Year of publication.")
+    background_objective: str = Field(description="Research background and objective in Japanese.")
+    results_summary: str = Field(description="Comprehensive summary of results/discussion in Japanese. Must logically connect the experimental data.")
+    results_figures: list[FigureOut]
+    novelty: str = Field(description="Novelty and significance in Japanese.")
+    conclusion_tasks: str = Field(description="Conclusion and future tasks in Japanese.")
+
+# Subsets for the split analysis; fields (and descriptions) are taken from AnalysisOut
+def _schema_subset(name, keys):
+    return create_model(name, **{
+        key: (field.annotation, field) for key, field in AnalysisOut.model_fields.items() if key in keys
+    })
+
+MetaOut = _schema_subset("MetaOut", META_FIELDS)
+ResultsOut = _schema_subset("ResultsOut", AnalysisOut.model_fields.keys() - set(META_FIELDS))
+
+# --- Analysis Cache ---
+
+class AnalysisCache:
+    """
+    Persists parsed Gemini results on disk, keyed by the content hash of the PDF,
+    so re-uploading the same paper skips the LLM round-trip.
+    """
+
+    def __init__(self, cache_dir=".analysis_cache"):
+        self.cache_dir = Path(cache_dir)
+
+    def _path(self, key):
+        return self.cache_dir / f"{key}.json"
+
+    def get(self, key):
+        path = self._path(key)
+        if not path.exists():
+            return None
+        try:
+            return orjson.loads(path.read_bytes())
+        except (OSError, orjson.JSONDecodeError) as e:
+            print(f"Error reading analysis cache: {e}")
+            return None
+
+    def put(self, key, data):
+        path = self._path(key)
+        try:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+            # Write to a temp file first so a crash never leaves a truncated entry. The name is
+            # unique per writer, so sessions storing the same key concurrently cannot interleave
+            tmp = tempfile.NamedTemporaryFile(dir=self.cache_dir, suffix=".tmp", delete=False)
+            try:
+                with tmp:
+                    tmp.write(orjson.dumps(data))
+                os.replace(tmp.name, path)
+            except OSError:
+                Path(tmp.name).unlink(missing_ok=True)
+                raise
+        except OSError as e:
+            print(f"Error writing analysis cache: {e}")
+
+analysis_cache = AnalysisCache()
+
+# Bump when the prompt or AnalysisOut changes so stale entries are not served
+ANALYSIS_CACHE_VERSION = "v2"
+
+def analysis_cache_key(file_hash):
+    return f"{file_hash}-{GEMINI_MODEL}-{GEMINI_META_MODEL}-{ANALYSIS_CACHE_VERSION}"
 
 # --- Helper Functions ---
 
-def get_api_key():
+@st.cache_resource(show_spinner=False)
+def _load_keys():
     """
-    Retrieves a random API key from a pool to distribute load.
+    Collects the API key pool once per process instead of probing
+    st.secrets and the environment on every rerun.
     Supports 'GEMINI_API_KEYS' (comma-separated list) or single 'GEMINI_API_KEY'.
     """
     keys = []
@@ -95,19 +158,33 @@ def get_api_key():
         if single_key:
             keys.append(single_key)
 
+    return tuple(keys)
+
+@st.cache_resource(show_spinner=False)
+def _key_counter():
+    """Process-wide request counter shared by all sessions (next() on it is atomic under the GIL)"""
+    return itertools.count()
+
+def get_api_key():
+    """Retrieves the next API key from the pool in round-robin order to distribute load."""
+    keys = _load_keys()
     if not keys:
+        # Don't pin an empty pool; keys added to the secrets later are picked up on the next rerun
+        _load_keys.clear()
         return None
     
-    # Return a random key from the pool
-    return random.choice(keys)
+    # Round-robin spreads concurrent sessions evenly, where random picks can pile onto one key's quota
+    return keys[next(_key_counter()) % len(keys)]
 
-def analyze_pdf_with_gemini(api_key, file_bytes):
-    if not api_key:
-        raise ValueError("API Key not found.")
-        
-    client = genai.Client(api_key=api_key)
+@st.cache_resource(show_spinner=False)
+def init_gemini_client(api_key):
+    """
+    One genai.Client per API key for the whole process, so repeated calls
+    reuse the SDK's pooled HTTPS connections instead of new handshakes.
+    """
+    return genai.Client(api_key=api_key)
 
-    system_instruction = """
+SYSTEM_INSTRUCTION = """
     あなたは優秀な化学者です。英語の化学論文(PDF)を深く読み込み、日本の研究者が理解しやすいように高度な要約を作成してください。
     
     以下の点を重視し、情報は省略せず、論理的なつながりを意識して詳細に記述してください:
@@ -132,141 +209,650 @@ def analyze_pdf_with_gemini(api_key, file_bytes):
     
     出力はJSON形式で行ってください。
     """
-    
-    try:
-        response = client.models.generate_content(
-            model='gemini-3-flash-preview',
+
+ANALYSIS_PROMPT = "この論文を解析し、JSON形式で出力してください。"
+# Prompts for the split analysis (see analyze_pdf_with_gemini); the schemas limit the fields
+META_PROMPT = "この論文のタイトル・書誌情報・背景・新規性・結論を解析し、JSON形式で出力してください。"
+RESULTS_PROMPT = "この論文の実験結果・考察と各図表を解析し、JSON形式で出力してください。"
+
+# Follow-up sent in the same conversation when the answer does not match AnalysisOut
+JSON_REPAIR_PROMPT = "直前の出力は指定のJSONスキーマに適合していません（途中で途切れている可能性があります）。スキーマに合うよう修正した完全なJSONのみを返してください。"
+# The repair only has to restructure an existing answer, so it needs little thinking
+REPAIR_THINKING_BUDGET = 1024
+
+MAX_THINKING_BUDGET = 16000
+
+# Papers this short whose text is also this sparse (figure-heavy letters) need less again
+SHORT_PAPER_PAGES = 3
+SHORT_PAPER_CHARS = 8000
+SHORT_PAPER_THINKING_BUDGET = 1500
+
+def thinking_budget_for(page_count, text_chars=None):
+    """ページ数に比例した思考トークン予算 (短いLetterで16000を払わないように)"""
+    # text_chars of 0 means a scanned PDF without a text layer, which says nothing about length
+    if text_chars and page_count <= SHORT_PAPER_PAGES and text_chars < SHORT_PAPER_CHARS:
+        return SHORT_PAPER_THINKING_BUDGET
+    return min(MAX_THINKING_BUDGET, max(2048, page_count * 400))
+
+def sample_text_chars(doc, pages=SHORT_PAPER_PAGES):
+    """先頭数ページのテキスト量（文字数）を数える"""
+    return sum(len(doc[i].get_text()) for i in range(min(pages, doc.page_count)))
+
+# The File API deletes uploads after 48 hours; used when the response has no expiration_time
+FILE_API_TTL_SECONDS = 48 * 3600
+
+def upload_pdf_to_gemini(api_key, pdf_path):
+    """
+    Uploads the PDF once through the Gemini File API and returns its URI
+    and expiry (epoch seconds). Files belong to the key's project, so later
+    calls must use the same key.
+    """
+    client = init_gemini_client(api_key)
+    uploaded = client.files.upload(
+        file=pdf_path,
+        config=types.UploadFileConfig(mime_type='application/pdf')
+    )
+    if uploaded.expiration_time:
+        expires = uploaded.expiration_time.timestamp()
+    else:
+        expires = time.time() + FILE_API_TTL_SECONDS
+    return uploaded.uri, expires
+
+GEMINI_MODEL = 'gemini-3-flash-preview'
+# Bibliographic fields, background, novelty and conclusion need no deep reading
+GEMINI_META_MODEL = 'gemini-2.5-flash-lite'
+META_THINKING_BUDGET = 1024
+CONTEXT_CACHE_TTL_SECONDS = 3600
+# After a failed caches.create, analyses run uncached for this long before it is tried again
+CONTEXT_CACHE_RETRY_SECONDS = 600
+
+def create_context_cache(api_key, file_uri):
+    """
+    Registers the system instruction and the uploaded PDF as an explicit
+    Gemini context cache and returns its name. Requests that reference it
+    pay the cached-token rate for that prefix.
+    """
+    client = init_gemini_client(api_key)
+    cache = client.caches.create(
+        model=GEMINI_MODEL,
+        config=types.CreateCachedContentConfig(
+            system_instruction=SYSTEM_INSTRUCTION,
             contents=[
                 types.Content(
-                    parts=[
-                        types.Part.from_bytes(data=file_bytes, mime_type='application/pdf'),
-                        types.Part.from_text(text="この論文を解析し、JSON形式で出力してください。")
-                    ]
+                    role='user',
+                    parts=[types.Part.from_uri(file_uri=file_uri, mime_type='application/pdf')]
                 )
             ],
-            config=types.GenerateContentConfig(
-                system_instruction=system_instruction,
-                response_mime_type="application/json",
-                response_schema=ANALYSIS_SCHEMA,
-                # Thinking budget increased to 16000 for deeper analysis
-                thinking_config=types.ThinkingConfig(thinking_budget=16000)
-            )
+            ttl=f"{CONTEXT_CACHE_TTL_SECONDS}s"
+        )
+    )
+    return cache.name
+
+def prepare_gemini_file(file_hash, pdf_path, api_key):
+    """
+    Returns this session's File API upload of the PDF, uploading it on first
+    use. When the same PDF is analyzed again, the system instruction + PDF
+    prefix is also put into a context cache (cache_name) for the re-run.
+    """
+    gemini_file = st.session_state.get("gemini_file")
+    # Re-upload before the File API drops the file; the margin covers a long analysis
+    if (not gemini_file or gemini_file["file_hash"] != file_hash
+            or time.time() >= gemini_file["uri_expires"] - 600):
+        uri, uri_expires = upload_pdf_to_gemini(api_key, pdf_path)
+        gemini_file = {
+            "file_hash": file_hash,
+            "api_key": api_key,
+            "uri": uri,
+            "uri_expires": uri_expires,
+            "cache_name": None,
+            "cache_expires": 0,
+        }
+        st.session_state.gemini_file = gemini_file
+    elif time.time() >= gemini_file["cache_expires"]:
+        try:
+            gemini_file["cache_name"] = create_context_cache(gemini_file["api_key"], gemini_file["uri"])
+            # Leave a margin so a cache is never referenced right as it expires
+            gemini_file["cache_expires"] = time.time() + CONTEXT_CACHE_TTL_SECONDS - 60
+        except Exception as e:
+            # Explicit caching can be unavailable (model, quota, prefix size); fall back to uncached
+            # calls, and don't pay for another failing create on every click
+            print(f"Error creating context cache: {e}")
+            gemini_file["cache_name"] = None
+            gemini_file["cache_expires"] = time.time() + CONTEXT_CACHE_RETRY_SECONDS
+    return gemini_file
+
+def _analysis_request(pdf_part, prompt=ANALYSIS_PROMPT, thinking_budget=MAX_THINKING_BUDGET, cached_content=None,
+                      schema=AnalysisOut, model=GEMINI_MODEL):
+    """
+    generate_content / generate_content_stream に渡す引数を組み立てる。
+    cached_contentを指定した場合、システム指示とPDFはキャッシュ側に含まれる。
+    """
+    parts = [types.Part.from_text(text=prompt)]
+    if not cached_content:
+        parts.insert(0, pdf_part)
+    return dict(
+        model=model,
+        contents=[types.Content(role="user", parts=parts)],
+        config=types.GenerateContentConfig(
+            cached_content=cached_content,
+            system_instruction=None if cached_content else SYSTEM_INSTRUCTION,
+            response_mime_type="application/json",
+            response_schema=schema,
+            # Up to 16000 for deeper analysis on long papers; see thinking_budget_for
+            thinking_config=types.ThinkingConfig(thinking_budget=thinking_budget)
         )
-        return json.loads(response.text)
+    )
+
+def _repair_request(request, broken_text, error):
+    """
+    スキーマ不適合の応答を修正させる追質問を組み立てる。
+    元の会話（PDFまたはキャッシュ参照を含む）をそのまま続けるので、解析全体はやり直さない。
+    errorのValidationErrorの内容を伝え、どこを直すべきかを明示する。
+    """
+    # Only the first few problems; a truncated answer reports one per missing field
+    problems = "\n".join(
+        f"- {'.'.join(map(str, err['loc'])) or '(root)'}: {err['msg']}" for err in error.errors()[:20]
+    )
+    prompt = f"{JSON_REPAIR_PROMPT}\n\n検証エラー:\n{problems}"
+    return dict(
+        model=request["model"],
+        contents=request["contents"] + [
+            types.Content(role="model", parts=[types.Part.from_text(text=broken_text)]),
+            types.Content(role="user", parts=[types.Part.from_text(text=prompt)]),
+        ],
+        config=request["config"].model_copy(update={
+            "thinking_config": types.ThinkingConfig(thinking_budget=REPAIR_THINKING_BUDGET)
+        })
+    )
+
+def _validate_or_repair(request, text, parsed=None):
+    """
+    Checks an answer against the request's response schema. Returns
+    (model instance, None) if it fits, otherwise (None, repair request).
+    parsed is the SDK's own parse of a non-streamed response, if any.
+    """
+    # The SDK already validated the JSON against the schema; parsed is None only if that failed
+    if parsed is not None:
+        return parsed, None
+    try:
+        return request["config"].response_schema.model_validate_json(text or ""), None
+    except ValidationError as e:
+        return None, _repair_request(request, text or "", e)
+
+def _repaired_answer(repair_request, response):
+    """Validates the answer to a repair turn; a second failure propagates to the caller"""
+    return response.parsed or repair_request["config"].response_schema.model_validate_json(response.text)
+
+def _generate_validated(client, request):
+    """Non-streaming call whose answer is validated against the request's schema, with one repair turn"""
+    response = client.models.generate_content(**request)
+    parsed, repair = _validate_or_repair(request, response.text, response.parsed)
+    if repair:
+        parsed = _repaired_answer(repair, client.models.generate_content(**repair))
+    return parsed
+
+def analyze_pdf_with_gemini(api_key, file_uri, page_count, on_progress=None, cached_content=None, text_chars=None,
+                            on_meta=None):
+    """
+    Analyzes a PDF uploaded with upload_pdf_to_gemini as two concurrent
+    calls: a fast GEMINI_META_MODEL call for META_FIELDS and the streamed
+    deep call for the results and figures. If given, on_meta is called
+    with the metadata dict as soon as it is available and on_progress with
+    the accumulated deep response text after every chunk. cached_content
+    replaces the instruction + PDF prefix of the deep call, and text_chars
+    (see sample_text_chars) refines its thinking budget.
+    """
+    if not api_key:
+        raise ValueError("API Key not found.")
+        
+    client = init_gemini_client(api_key)
+    pdf_part = types.Part.from_uri(file_uri=file_uri, mime_type='application/pdf')
+
+    # The metadata call cannot use the context cache, which is bound to GEMINI_MODEL
+    meta_request = _analysis_request(
+        pdf_part, META_PROMPT, thinking_budget=META_THINKING_BUDGET, schema=MetaOut, model=GEMINI_META_MODEL
+    )
+    executor = ThreadPoolExecutor(max_workers=1)
+    meta_future = executor.submit(_generate_validated, client, meta_request)
+
+    response_text = ""
+    try:
+        request = _analysis_request(
+            pdf_part, RESULTS_PROMPT,
+            thinking_budget=thinking_budget_for(page_count, text_chars),
+            cached_content=cached_content,
+            schema=ResultsOut
+        )
+        stream = client.models.generate_content_stream(**request)
+        for chunk in stream:
+            # Streamlit elements may only be updated from the script thread, so poll here
+            if on_meta and meta_future.done() and meta_future.exception() is None:
+                on_meta(meta_future.result().model_dump())
+                on_meta = None
+            # Thought-only chunks carry no text
+            if chunk.text:
+                response_text += chunk.text
+                if on_progress:
+                    on_progress(response_text)
+        results, repair = _validate_or_repair(request, response_text)
+        if repair:
+            results = _repaired_answer(repair, client.models.generate_content(**repair))
+        try:
+            # Usually finished long ago; otherwise wait for it here
+            meta = meta_future.result()
+        except Exception as e:
+            # The deep results are already paid for, so don't lose them to the cheap call:
+            # ask GEMINI_MODEL for the metadata instead, reusing the context cache if there is one
+            print(f"Metadata call with {GEMINI_META_MODEL} failed, retrying with {GEMINI_MODEL}: {e}")
+            meta = _generate_validated(client, _analysis_request(
+                pdf_part, META_PROMPT, thinking_budget=META_THINKING_BUDGET,
+                cached_content=cached_content, schema=MetaOut
+            ))
+        if on_meta:
+            # The metadata arrived after the last stream chunk (or the stream had few chunks)
+            on_meta(meta.model_dump())
+        merged = {**meta.model_dump(), **results.model_dump()}
+        return AnalysisOut.model_validate(merged).model_dump()
     except Exception as e:
+        if response_text:
+            # Keep the tail of what already streamed in; it shows where the answer broke off
+            raise RuntimeError(
+                f"{e} (受信済み {len(response_text):,} 文字, 末尾: {response_text[-300:]!r})"
+            ) from e
         # Rethrow to be caught by the caller
         raise e
+    finally:
+        # On failure, don't hold the caller until the metadata call returns
+        executor.shutdown(wait=False)
+
+# Papers longer than LONG_PDF_PAGES are analyzed as CHUNK_PAGES-page slices in parallel
+LONG_PDF_PAGES = 40
+CHUNK_PAGES = 20
+# Uploads above this size are rejected before any parsing or API call
+MAX_PDF_BYTES = 40 * 1024 * 1024
+
+def split_pdf(src, k=CHUNK_PAGES):
+    """開いているPDF (fitz.Document) をkページごとに分割し、(開始ページ, PDFバイト列) のリストを返す"""
+    import fitz  # PyMuPDF
+    
+    chunks = []
+    for start in range(0, src.page_count, k):
+        with fitz.open() as part:
+            part.insert_pdf(src, from_page=start, to_page=min(start + k, src.page_count) - 1)
+            chunks.append((start, part.tobytes()))
+    return chunks
 
-def extract_images_from_pdf(file_bytes, analysis_data):
-    """PyMuPDFを使ってbboxに基づき画像を切り出す"""
-    doc = fitz.open(stream=file_bytes, filetype="pdf")
-    enriched_figures = []
+async def _analyze_chunks(client, chunks, k):
+    async def analyze_chunk(start, chunk_bytes):
+        prompt = ANALYSIS_PROMPT
+        if start > 0:
+            prompt = (
+                f"これは長い論文の一部（元のPDFの{start + 1}ページ目以降の抜粋）です。"
+                "page_numberはこの抜粋内での1始まりのページ番号で指定してください。" + prompt
+            )
+        request = _analysis_request(
+            types.Part.from_bytes(data=chunk_bytes, mime_type='application/pdf'),
+            prompt,
+            thinking_budget=thinking_budget_for(k)
+        )
+        response = await client.aio.models.generate_content(**request)
+        parsed, repair = _validate_or_repair(request, response.text, response.parsed)
+        if repair:
+            parsed = _repaired_answer(repair, await client.aio.models.generate_content(**repair))
+        return parsed.model_dump()
     
-    for fig in analysis_data.get("results_figures", []):
+    return await asyncio.gather(*[analyze_chunk(start, chunk_bytes) for start, chunk_bytes in chunks])
+
+def analyze_pdf_in_chunks(api_key, pdf_doc, k=CHUNK_PAGES):
+    """
+    Analyzes a long PDF (the session's open fitz.Document) as k-page chunks
+    with concurrent Gemini calls and merges the results. Header fields come
+    from the first chunk, the conclusion from the last one.
+    """
+    if not api_key:
+        raise ValueError("API Key not found.")
+    
+    # Not the cached client: its async transport would be bound to a previous asyncio.run loop
+    client = genai.Client(api_key=api_key)
+    chunks = split_pdf(pdf_doc, k)
+    results = asyncio.run(_analyze_chunks(client, chunks, k))
+    
+    merged = dict(results[0])
+    merged["results_summary"] = "\n\n".join(r.get("results_summary", "") for r in results if r.get("results_summary"))
+    merged["conclusion_tasks"] = results[-1].get("conclusion_tasks", merged.get("conclusion_tasks", ""))
+    merged["results_figures"] = []
+    for (start, _), result in zip(chunks, results):
+        for fig in result.get("results_figures", []):
+            # Page numbers are relative to the chunk; shift them back to the full document
+            fig["page_number"] = fig.get("page_number", 1) + start
+            merged["results_figures"].append(fig)
+    return merged
+
+# Figures are shown at column width, so render just enough pixels for that.
+# The DPI is derived from the clip width and clamped to keep small text legible.
+TARGET_DISPLAY_PX = 900
+MIN_RENDER_DPI = 100
+MAX_RENDER_DPI = 200
+# Longest side of a crop in pixels; the report shows figures at most 500px tall, so
+# tall, narrow figures need no 200 DPI raster in the page or the clipboard HTML
+MAX_RENDER_PX = 1200
+JPEG_QUALITY = 85
+# Grayscale crops are kept lossless (PNG) unless that gets this large; colour crops
+# always go to JPEG, which is several times smaller and faster to encode
+PNG_MAX_BYTES = 400 * 1024
+# Smallest bbox side (on Gemini's 0-1000 scale) worth rendering; smaller boxes are misdetections
+MIN_BBOX_EXTENT = 30
+# Crops up to this size are inlined as data URIs instead of going through Streamlit's media endpoint
+INLINE_IMAGE_MAX_BYTES = 100 * 1024
+
+def render_dpi_for(clip_width_pt, clip_height_pt):
+    """
+    切り出し幅(pt)がTARGET_DISPLAY_PX程度になるDPIを返す。
+    ただし長辺はMAX_RENDER_PXを超えないようにする。
+    """
+    if clip_width_pt <= 0:
+        return MAX_RENDER_DPI
+    dpi = min(MAX_RENDER_DPI, max(MIN_RENDER_DPI, int(TARGET_DISPLAY_PX / clip_width_pt * 72)))
+    return min(dpi, int(MAX_RENDER_PX / max(clip_width_pt, clip_height_pt) * 72))
+
+def encode_crop(pixels):
+    """
+    切り出し画像 (h, w, 3) をエンコードし、(バイト列, MIMEタイプ) を返す。
+    カラーはJPEG、グレースケールはPNG（大きすぎる場合はJPEG）。
+    """
+    from PIL import Image
+    
+    if (pixels[..., 0] == pixels[..., 1]).all() and (pixels[..., 1] == pixels[..., 2]).all():
+        # Black-and-white line art, spectra and text: JPEG ringing shows around thin strokes,
+        # while a single-channel PNG of such crops stays small
+        image = Image.fromarray(pixels[..., 0])
+        buffered = io.BytesIO()
+        # compress_level=1: a few percent larger than the default, but zlib runs much faster
+        image.save(buffered, format="PNG", compress_level=1)
+        if buffered.tell() <= PNG_MAX_BYTES:
+            return buffered.getvalue(), "image/png"
+    else:
+        image = Image.fromarray(pixels)
+    buffered = io.BytesIO()
+    image.save(buffered, format="JPEG", quality=JPEG_QUALITY)
+    return buffered.getvalue(), "image/jpeg"
+
+def _render_page(page, clips):
+    """ページを1回だけ解析し、各図の領域だけをレンダリングしてエンコードする"""
+    import fitz  # PyMuPDF
+    import numpy as np
+    
+    # The display list holds the parsed page content, so each figure is a cheap replay
+    # that rasterizes only its own clip, at the DPI that clip needs
+    display_list = page.get_displaylist()
+    crops = []
+    for idx, clip in clips:
+        zoom = render_dpi_for(clip[2] - clip[0], clip[3] - clip[1]) / 72
+        # alpha=False pins the raster to 3-channel RGB: JPEG has no alpha plane, and
+        # Image.fromarray then always sees an (h, w, 3) array without any mode juggling
+        pix = display_list.get_pixmap(matrix=fitz.Matrix(zoom, zoom), clip=fitz.Rect(clip), alpha=False)
+        # samples_mv is a view of MuPDF's own buffer (samples would copy it).
+        # The buffer belongs to pix, so pix must stay referenced until the crop is encoded.
+        pixels = np.frombuffer(pix.samples_mv, dtype=np.uint8).reshape(pix.height, pix.width, pix.n)
+        # Encode once here; the bytes are reused for display and the clipboard HTML
+        crops.append((idx, encode_crop(pixels)))
+    display_list = None
+    return crops
+
+_JSON_DECODER = json.JSONDecoder()
+_JSON_SEPARATOR_RE = re.compile(r"[\s,:]*")
+
+def parse_partial_json(text):
+    """
+    Returns the top-level key/value pairs of a still-streaming JSON object
+    that are already complete. Parsing stops at the first incomplete value.
+    """
+    fields = {}
+    start = text.find("{")
+    if start < 0:
+        return fields
+    
+    idx = start + 1
+    while True:
+        idx = _JSON_SEPARATOR_RE.match(text, idx).end()
+        if idx >= len(text) or text[idx] != '"':
+            break
+        try:
+            key, idx = _JSON_DECODER.raw_decode(text, idx)
+            idx = _JSON_SEPARATOR_RE.match(text, idx).end()
+            value, idx = _JSON_DECODER.raw_decode(text, idx)
+        except json.JSONDecodeError:
+            break
+        # A value at the very end of the buffer may still be growing (e.g. a number)
+        if idx >= len(text):
+            break
+        fields[key] = value
+    return fields
+
+UPLOAD_DIR = Path(tempfile.gettempdir()) / "chemai_uploads"
+# Saved uploads (and stray .part files) not written or reused for this long are deleted
+UPLOAD_MAX_AGE_SECONDS = 6 * 3600
+
+def evict_old_uploads(max_age=UPLOAD_MAX_AGE_SECONDS):
+    """一定時間使われていない保存済みPDFを削除する"""
+    cutoff = time.time() - max_age
+    for path in UPLOAD_DIR.glob("*"):
         try:
-            page_num = fig.get("page_number", 1) - 1
-            if page_num < 0 or page_num >= len(doc):
-                enriched_figures.append(fig)
+            if path.stat().st_mtime < cutoff:
+                path.unlink()
+        except OSError:
+            # Already removed by another session
+            pass
+
+def save_upload_to_disk(uploaded_file, file_hash):
+    """
+    Copies the upload to a content-named file in the temp dir and returns its
+    path. MuPDF and the File API read the PDF from there, so the app holds no
+    second in-memory copy. Sessions uploading the same paper share the file.
+    """
+    pdf_path = UPLOAD_DIR / f"{file_hash}.pdf"
+    if pdf_path.exists():
+        # Mark it as in use so evict_old_uploads keeps it
+        os.utime(pdf_path)
+        return str(pdf_path)
+    UPLOAD_DIR.mkdir(parents=True, exist_ok=True)
+    evict_old_uploads()
+    # Copy to a temp name first so other sessions never open a half-written PDF
+    tf = tempfile.NamedTemporaryFile(dir=UPLOAD_DIR, suffix=".part", delete=False)
+    try:
+        with tf:
+            uploaded_file.seek(0)
+            shutil.copyfileobj(uploaded_file, tf, length=1 << 20)
+        os.replace(tf.name, pdf_path)
+    except BaseException:
+        Path(tf.name).unlink(missing_ok=True)
+        raise
+    return str(pdf_path)
+
+def open_pdf(pdf_path):
+    """PDFを開き、Documentと各ページのサイズを返す (アップロードごとに1回だけ呼ぶ)"""
+    import fitz  # PyMuPDF
+    
+    doc = fitz.open(pdf_path)
+    page_rects = [page.rect for page in doc]
+    return doc, page_rects
+
+@st.cache_data(show_spinner=False, max_entries=16)
+def render_figure_images(file_hash, figures_json, _pdf_doc, _page_rects):
+    """
+    Renders the figure crops and returns {figure index: (image bytes, mime)}.
+    Cached on the PDF hash plus the serialized figure list, so repeated
+    extraction of the same analysis skips PyMuPDF entirely. _pdf_doc is the
+    session's already open fitz.Document of that PDF.
+    """
+    import numpy as np
+    
+    figures = orjson.loads(figures_json)
+    page_rects = _page_rects
+    images = {}
+    # Group clips by page so each page is parsed only once
+    clips_by_page = defaultdict(list)
+    
+    # Keep only figures that point at an existing page with a usable bbox; the rest
+    # are shown text-only instead of as a sliver or an empty crop
+    valid = []
+    for idx, fig in enumerate(figures):
+        page_num = fig.get("page_number", 1) - 1
+        bbox = fig.get("bbox", [])
+        if not (0 <= page_num < len(page_rects) and len(bbox) == 4):
+            continue
+        ymin, xmin, ymax, xmax = bbox
+        # Also rejects inverted boxes, whose extent is negative
+        if ymax - ymin < MIN_BBOX_EXTENT or xmax - xmin < MIN_BBOX_EXTENT:
+            continue
+        valid.append((idx, page_num, bbox))
+    
+    if valid:
+        # Convert 0-1000 scale to actual PDF coordinates for all figures at once
+        # bbox from Gemini is [ymin, xmin, ymax, xmax]
+        padding = 20
+        boxes = np.array([bbox for _, _, bbox in valid], dtype=np.float64)
+        dims = np.array(
+            [[page_rects[p].height, page_rects[p].width] * 2 for _, p, _ in valid],
+            dtype=np.float64
+        )
+        pads = np.array([-padding, -padding, padding, padding], dtype=np.float64)
+        clips = np.clip((boxes + pads) / 1000 * dims, 0, dims)
+        
+        for (idx, page_num, _), (y1, x1, y2, x2) in zip(valid, clips.tolist()):
+            # A bbox lying entirely off the page clamps to zero area
+            if x2 <= x1 or y2 <= y1:
                 continue
-                
-            page = doc[page_num]
-            rect = page.rect  # Page size
-            bbox = fig.get("bbox", [])
-            
-            if len(bbox) == 4:
-                # Convert 0-1000 scale to actual PDF coordinates
-                # bbox from Gemini is [ymin, xmin, ymax, xmax]
-                ymin, xmin, ymax, xmax = bbox
-                
-                # Add padding
-                padding = 20
-                h = rect.height
-                w = rect.width
-                
-                y1 = max(0, (ymin - padding) / 1000 * h)
-                x1 = max(0, (xmin - padding) / 1000 * w)
-                y2 = min(h, (ymax + padding) / 1000 * h)
-                x2 = min(w, (xmax + padding) / 1000 * w)
-                
-                clip_rect = fitz.Rect(x1, y1, x2, y2)
-                pix = page.get_pixmap(clip=clip_rect, dpi=200)
-                
-                # Convert to PIL Image for Streamlit
-                img_data = pix.tobytes("png")
-                image = Image.open(io.BytesIO(img_data))
-                
-                # Store object for display (cannot JSON serialize PIL image easily)
-                fig["pil_image"] = image
-                
+            clips_by_page[page_num].append((idx, (x1, y1, x2, y2)))
+    
+    # PyMuPDF holds the GIL while rendering, so threads would not overlap; one pass over
+    # the session's Document, page by page, does the same work without reopening the PDF
+    for page_num, clips in clips_by_page.items():
+        try:
+            for idx, encoded in _render_page(_pdf_doc[page_num], clips):
+                images[idx] = encoded
         except Exception as e:
             print(f"Error extracting image: {e}")
+    
+    if clips_by_page:
+        import fitz  # PyMuPDF
         
-        enriched_figures.append(fig)
-        
-    analysis_data["results_figures"] = enriched_figures
+        # Drop the decoded fonts, images and display data this pass left in MuPDF's store.
+        # Only entries nothing references are evicted, so other sessions' documents are unaffected.
+        fitz.TOOLS.store_shrink(100)
+    
+    return images
+
+def extract_images_from_pdf(file_hash, pdf_doc, page_rects, analysis_data):
+    """PyMuPDFを使ってbboxに基づき画像を切り出す (pdf_docはセッションで開いているDocument)"""
+    figures = analysis_data.get("results_figures", [])
+    figures_json = orjson.dumps(figures, option=orjson.OPT_SORT_KEYS)
+    for idx, (image_bytes, mime) in render_figure_images(file_hash, figures_json, pdf_doc, page_rects).items():
+        figures[idx]["mime"] = mime
+        # Each crop is kept in exactly one form: small ones only as the data URI, which both
+        # the display and the clipboard use as-is on every rerun, larger ones as raw bytes
+        if len(image_bytes) <= INLINE_IMAGE_MAX_BYTES:
+            figures[idx]["img_data_uri"] = f"data:{mime};base64," + base64.b64encode(image_bytes).decode("ascii")
+        else:
+            figures[idx]["image_bytes"] = image_bytes
+    
+    analysis_data["results_figures"] = figures
     return analysis_data
 
+# A negated class instead of (.*?) so a stray ** cannot make the scan backtrack over the text
+_BOLD_RE = re.compile(r'\*\*([^*]+)\*\*')
+
 def format_text(text):
     """Simple text formatter for HTML output"""
     if not text:
         return ""
-    # Escape HTML special characters
-    safe = html_lib.escape(text)
-    # Convert newlines to breaks
-    safe = safe.replace("\n", "<br>")
+    # Escape HTML special characters and convert newlines to breaks
+    safe = html_lib.escape(text).replace("\n", "<br>")
     # Convert simple bold **text** to <strong>text</strong>
-    safe = re.sub(r'\*\*(.*?)\*\*', r'<strong>\1</strong>', safe)
-    return safe
+    return _BOLD_RE.sub(r'<strong>\1</strong>', safe)
 
-def generate_html_for_clipboard(result):
+# On-screen report blocks around the figure loop. Fields are passed through
+# format_text, which keeps each one on a single HTML line so indentation or
+# blank lines in the text cannot break the markdown HTML block.
+REPORT_FIELDS = ("title_jp", "title_en", "journal_authors", "publication_year",
+                 "background_objective", "results_summary", "novelty", "conclusion_tasks")
+
+REPORT_HEAD_TPL = string.Template("\n".join([
+    # Header
+    '<div class="report-header">',
+    '<div class="report-meta">Chemistry Research Summary | $publication_year</div>',
+    '<div class="report-title">$title_jp</div>',
+    '<div style="font-size: 1.1em; color: #4b5563; margin-top: 5px;">$title_en</div>',
+    '<div style="margin-top: 15px; font-size: 0.9em;">📖 $journal_authors</div>',
+    '</div>',
+    # 1. Background
+    '<div class="section-header">1. 目的・動機・研究背景</div>',
+    '<div>$background_objective</div>',
+    # 2. Results
+    '<div class="section-header">2. 実験結果・考察</div>',
+    '<div class="summary-box"><strong>全体要約:</strong><br>$results_summary</div>',
+]))
+
+REPORT_TAIL_TPL = string.Template("\n".join([
+    # 3. Novelty
+    '<div class="section-header">3. 新規性・学術的意義</div>',
+    '<div class="novelty-box">$novelty</div>',
+    # 4. Conclusion
+    '<div class="section-header">4. 結論・今後の課題</div>',
+    '<div>$conclusion_tasks</div>',
+]))
+
+def report_fields_for(result):
+    """Formats the report's text fields for the on-screen templates"""
+    report_fields = {key: format_text(result.get(key, "")) for key in REPORT_FIELDS}
+    report_fields["publication_year"] = format_text(result.get("publication_year", "N/A"))
+    return report_fields
+
+def render_report_sections(result):
     """
-    Generates a complete HTML string with inline styles and base64 images
-    suitable for pasting into OneNote/Word.
+    Formats the on-screen report: returns the head and tail HTML blocks
+    and the header line of every figure.
     """
-    html = f"""
-    <div style="color: #1f2937; max-width: 800px;">
-        <h1 style="font-size: 24px; font-weight: bold; color: #111827; margin-bottom: 8px;">{format_text(result['title_jp'])}</h1>
-        <h2 style="font-size: 18px; color: #4b5563; margin-bottom: 8px;">{format_text(result['title_en'])}</h2>
-        <div style="margin-bottom: 24px; color: #6b7280; font-size: 14px; border-bottom: 1px solid #e5e7eb; padding-bottom: 12px;">
-            <span style="font-weight: bold;">{format_text(result['journal_authors'])}</span> | <span>{format_text(result.get('publication_year', 'N/A'))}</span>
-        </div>
+    report_fields = report_fields_for(result)
+    figure_headers = [
+        f"**{fig['label']}** (Page {fig['page_number']})" for fig in result['results_figures']
+    ]
+    return (
+        REPORT_HEAD_TPL.safe_substitute(report_fields),
+        REPORT_TAIL_TPL.safe_substitute(report_fields),
+        figure_headers,
+    )
 
-        <h3 style="font-size: 18px; font-weight: bold; color: #0f766e; border-bottom: 2px solid #ccfbf1; padding-bottom: 6px; margin-top: 24px; margin-bottom: 12px;">1. 目的・動機・研究背景</h3>
-        <p style="line-height: 1.6; margin-bottom: 16px;">{format_text(result['background_objective'])}</p>
+# Clipboard (OneNote/Word) document template, next to this file
+REPORT_TEMPLATE_PATH = Path(__file__).with_name("report.html")
 
-        <h3 style="font-size: 18px; font-weight: bold; color: #0f766e; border-bottom: 2px solid #ccfbf1; padding-bottom: 6px; margin-top: 24px; margin-bottom: 12px;">2. 実験結果・考察</h3>
-        <div style="background-color: #f9fafb; padding: 16px; border-left: 4px solid #2dd4bf; margin-bottom: 24px;">
-            <strong style="display: block; margin-bottom: 8px; color: #374151;">全体要約:</strong>
-            <p style="line-height: 1.6; margin: 0;">{format_text(result['results_summary'])}</p>
-        </div>
-    """
+@st.cache_resource(show_spinner=False)
+def _clipboard_template():
+    """report.htmlを一度だけ読み込み、コンパイル済みのJinja2テンプレートを返す"""
+    import jinja2
+    from markupsafe import Markup
     
-    for fig in result['results_figures']:
-        img_html = ""
-        if "pil_image" in fig:
-            # Convert PIL image to base64 for embedding in HTML
-            buffered = io.BytesIO()
-            fig["pil_image"].save(buffered, format="PNG")
-            img_b64 = base64.b64encode(buffered.getvalue()).decode()
-            img_html = f'<div style="text-align: center; margin-bottom: 16px;"><img src="data:image/png;base64,{img_b64}" style="max-width: 100%; height: auto; display: block; margin: 0 auto; max-height: 500px;" /></div>'
-        
-        html += f"""
-        <div style="margin-bottom: 32px; border: 1px solid #e5e7eb; border-radius: 8px; padding: 16px; background-color: #fff;">
-            <p style="font-weight: bold; color: #334155; margin-bottom: 12px; font-size: 16px;">{format_text(fig['label'])} (Page {fig.get('page_number', '?')})</p>
-            {img_html}
-            <p style="line-height: 1.6; color: #374151;">{format_text(fig['explanation'])}</p>
-        </div>
-        """
-        
-    html += f"""
-        <h3 style="font-size: 18px; font-weight: bold; color: #0f766e; border-bottom: 2px solid #ccfbf1; padding-bottom: 6px; margin-top: 24px; margin-bottom: 12px;">3. 新規性・学術的意義</h3>
-        <div style="line-height: 1.6; margin-bottom: 16px; background-color: #eff6ff; padding: 12px; border-left: 4px solid #3b82f6;">{format_text(result['novelty'])}</div>
+    def rich_text(text):
+        # format_text escapes the text itself, so mark the result safe for autoescape
+        return Markup(format_text(text))
+    
+    env = jinja2.Environment(autoescape=True)
+    env.filters["rich_text"] = rich_text
+    return env.from_string(REPORT_TEMPLATE_PATH.read_text(encoding="utf-8"))
 
-        <h3 style="font-size: 18px; font-weight: bold; color: #0f766e; border-bottom: 2px solid #ccfbf1; padding-bottom: 6px; margin-top: 24px; margin-bottom: 12px;">4. 結論・今後の課題</h3>
-        <p style="line-height: 1.6; margin-bottom: 16px;">{format_text(result['conclusion_tasks'])}</p>
-    </div>
+def generate_html_for_clipboard(result):
     """
-    return html
+    Generates a complete HTML string with inline styles and base64 images
+    suitable for pasting into OneNote/Word.
+    """
+    figures = []
+    for fig in result['results_figures']:
+        # Embed the already-encoded crop; small ones already carry their data URI from display
+        data_uri = fig.get("img_data_uri")
+        if data_uri is None and "image_bytes" in fig:
+            data_uri = f"data:{fig['mime']};base64," + base64.b64encode(fig["image_bytes"]).decode("ascii")
+        figures.append((fig, data_uri))
+    return _clipboard_template().render(result=result, figures=figures)
 
 # --- Auth Logic ---
 if 'authenticated' not in st.session_state:
@@ -293,32 +879,126 @@ if not st.session_state.authenticated:
 st.title("🧪 ChemAI Paper Analyst")
 st.caption("Powered by Gemini 3.0 Flash (Multi-Key Load Balancing)")
 
-# Check if at least one key exists
-test_key = get_api_key()
-if not test_key:
+# Check if at least one key exists; get_api_key() is only called when a request is sent,
+# so reruns don't advance the shared round-robin counter
+if not _load_keys():
+    # Don't pin an empty pool; keys added to the secrets later are picked up on the next rerun
+    _load_keys.clear()
     st.warning("⚠️ API Keyが設定されていません。`GEMINI_API_KEYS` (カンマ区切り) または `GEMINI_API_KEY` を設定してください。")
     st.stop()
 
+use_cache = st.sidebar.checkbox("解析キャッシュを使う", value=True, help="同じPDFの解析結果を再利用します。オフにするとGeminiで再解析します。")
+
 uploaded_file = st.file_uploader("PDFファイルをアップロードしてください", type="pdf")
 
+# Fields shown while the Gemini response is still streaming
+STREAM_PREVIEW = {
+    "title_jp": "### {}",
+    "title_en": "*{}*",
+    "journal_authors": "📖 {}",
+    "publication_year": "📅 {}",
+    "background_objective": "**1. 目的・動機・研究背景**\n\n{}",
+    "results_summary": "**2. 実験結果・考察**\n\n{}",
+}
+
 if 'analysis_result' not in st.session_state:
     st.session_state.analysis_result = None
 
+def close_session_pdf():
+    """セッションが保持しているfitz.Documentを閉じる"""
+    pdf_doc = st.session_state.pop("pdf_doc", None)
+    if pdf_doc is not None:
+        pdf_doc.close()
+    # Without an open document the stored file state is stale as well
+    for key in ("page_rects", "file_hash", "pdf_path", "upload_id"):
+        st.session_state.pop(key, None)
+
+if uploaded_file is None and st.session_state.get("pdf_doc") is not None:
+    # The file was removed from the uploader; release the document right away.
+    # The report itself stays visible, it no longer needs the PDF.
+    close_session_pdf()
+
 if uploaded_file is not None:
+    if uploaded_file.size > MAX_PDF_BYTES:
+        st.error(f"PDFが大きすぎます ({uploaded_file.size / 1024 / 1024:.1f} MB)。{MAX_PDF_BYTES // 1024 // 1024} MB以下のファイル（例: SIを除いた本文のみ）をアップロードしてください。")
+        st.stop()
+    
+    # Every rerun hands back the same UploadedFile; its file_id only changes when a file
+    # is (re)uploaded, so the bytes are hashed once per upload instead of once per rerun
+    if st.session_state.get("upload_id") != uploaded_file.file_id:
+        # Content hash keying the analysis cache and the figure render cache; BLAKE2b is
+        # faster than SHA-256 in CPython and 128 bits is plenty for telling uploads apart
+        file_hash = hashlib.blake2b(uploaded_file.getvalue(), digest_size=16).hexdigest()
+        if st.session_state.get("file_hash") != file_hash:
+            # A different paper was uploaded; drop results that belong to the previous one
+            try:
+                pdf_path = save_upload_to_disk(uploaded_file, file_hash)
+                pdf_doc, page_rects = open_pdf(pdf_path)
+            except Exception as e:
+                st.error(f"PDFを開けませんでした: {str(e)}")
+                st.stop()
+            close_session_pdf()
+            # Opened once per upload and reused by every later rerun
+            st.session_state.pdf_doc = pdf_doc
+            st.session_state.page_rects = page_rects
+            st.session_state.file_hash = file_hash
+            st.session_state.pdf_path = pdf_path
+            st.session_state.analysis_result = None
+        st.session_state.upload_id = uploaded_file.file_id
+    elif not os.path.exists(st.session_state.pdf_path):
+        # Evicted while this session sat idle; the File API upload still reads the PDF from disk
+        save_upload_to_disk(uploaded_file, st.session_state.file_hash)
+
+    if st.session_state.pdf_doc.page_count > LONG_PDF_PAGES:
+        st.warning(f"⚠️ {st.session_state.pdf_doc.page_count}ページの長いPDFです。{CHUNK_PAGES}ページごとに分割して並列に解析します（ストリーミング表示なし）。")
+
     # Button to start analysis
     if st.button("論文を解析する (Deep Analysis)", type="primary"):
         # Select a key specifically for this request
         current_api_key = get_api_key()
         
         with st.spinner("Gemini 3.0 Flash が論文を深く読み込んでいます... (思考中...)"):
-            file_bytes = uploaded_file.read()
+            pdf_path = st.session_state.pdf_path
+            file_hash = st.session_state.file_hash
             try:
-                raw_analysis = analyze_pdf_with_gemini(current_api_key, file_bytes)
+                cache_key = analysis_cache_key(file_hash)
+                raw_analysis = analysis_cache.get(cache_key) if use_cache else None
+                if raw_analysis is None:
+                    received_slot = st.empty()
+                    preview_slots = {key: st.empty() for key in STREAM_PREVIEW}
+                    
+                    def show_fields(fields):
+                        for key, value in fields.items():
+                            if key in preview_slots and isinstance(value, str):
+                                preview_slots.pop(key).markdown(STREAM_PREVIEW[key].format(value))
+                    
+                    def show_streamed_fields(text):
+                        received_slot.caption(f"受信中... {len(text):,} 文字")
+                        # Fill each preview slot once its field has fully streamed in
+                        show_fields(parse_partial_json(text))
+                    
+                    page_count = st.session_state.pdf_doc.page_count
+                    if page_count > LONG_PDF_PAGES:
+                        raw_analysis = analyze_pdf_in_chunks(current_api_key, st.session_state.pdf_doc)
+                    else:
+                        gemini_file = prepare_gemini_file(file_hash, pdf_path, current_api_key)
+                        # The upload and its cache are only visible to the key that created them
+                        current_api_key = gemini_file["api_key"]
+                        raw_analysis = analyze_pdf_with_gemini(
+                            current_api_key, gemini_file["uri"], page_count,
+                            on_progress=show_streamed_fields, cached_content=gemini_file["cache_name"],
+                            text_chars=sample_text_chars(st.session_state.pdf_doc),
+                            # The metadata call usually finishes long before the deep one
+                            on_meta=show_fields
+                        )
+                    analysis_cache.put(cache_key, raw_analysis)
                 
                 if raw_analysis:
                     with st.spinner("図表を切り出しています..."):
-                        final_analysis = extract_images_from_pdf(file_bytes, raw_analysis)
+                        final_analysis = extract_images_from_pdf(file_hash, st.session_state.pdf_doc, st.session_state.page_rects, raw_analysis)
                         st.session_state.analysis_result = final_analysis
+                        # A fresh (uncached) analysis of the same PDF can differ, so key the report per run
+                        st.session_state.report_key = f"{file_hash}-{time.time_ns()}"
                     st.rerun()
             except Exception as e:
                 st.error(f"Analysis Failed: {str(e)}")
@@ -327,54 +1007,27 @@ if uploaded_file is not None:
 result = st.session_state.analysis_result
 
 if result:
-    # Header
-    st.markdown(f"""
-    <div class="report-header">
-        <div class="report-meta">Chemistry Research Summary | {result.get('publication_year', 'N/A')}</div>
-        <div class="report-title">{result['title_jp']}</div>
-        <div style="font-size: 1.1em; color: #4b5563; margin-top: 5px;">{result['title_en']}</div>
-        <div style="margin-top: 15px; font-size: 0.9em;">📖 {result['journal_authors']}</div>
-    </div>
-    """, unsafe_allow_html=True)
-
-    # 1. Background
-    st.markdown('<div class="section-header">1. 目的・動機・研究背景</div>', unsafe_allow_html=True)
-    st.write(result['background_objective'])
+    # Static sections are sent as one markdown element each (before/after the figures)
+    # instead of one WebSocket delta per block.
+    head_html, tail_html, figure_headers = render_report_sections(result)
+    st.markdown(head_html, unsafe_allow_html=True)
 
-    # 2. Results
-    st.markdown('<div class="section-header">2. 実験結果・考察</div>', unsafe_allow_html=True)
-    
-    st.markdown(f"""
-    <div class="summary-box">
-        <strong>全体要約:</strong><br>
-        {result['results_summary']}
-    </div>
-    """, unsafe_allow_html=True)
-
-    for fig in result['results_figures']:
-        st.markdown(f"**{fig['label']}** (Page {fig['page_number']})")
+    for fig, header in zip(result['results_figures'], figure_headers):
+        st.markdown(header)
         
         col1, col2 = st.columns([1, 1])
         with col1:
-            if "pil_image" in fig:
-                st.image(fig["pil_image"], use_container_width=True)
+            if "img_data_uri" in fig:
+                st.markdown(f"<img src='{fig['img_data_uri']}' style='width:100%'>", unsafe_allow_html=True)
+            elif "image_bytes" in fig:
+                st.image(fig["image_bytes"], use_container_width=True)
             else:
                 st.info("画像なし")
         with col2:
             st.write(fig['explanation'])
         st.divider()
 
-    # 3. Novelty
-    st.markdown('<div class="section-header">3. 新規性・学術的意義</div>', unsafe_allow_html=True)
-    st.markdown(f"""
-    <div class="novelty-box">
-        {result['novelty']}
-    </div>
-    """, unsafe_allow_html=True)
-
-    # 4. Conclusion
-    st.markdown('<div class="section-header">4. 結論・今後の課題</div>', unsafe_allow_html=True)
-    st.write(result['conclusion_tasks'])
+    st.markdown(tail_html, unsafe_allow_html=True)
 
     # --- Copy Section for OneNote ---
     st.divider()
@@ -382,9 +1035,14 @@ if result:
     st.info("以下のボタンを押すと、画像を含むレポート全体をクリップボードにコピーします。OneNoteやWordに貼り付けてください。")
     
     # Generate HTML content
-    html_content = generate_html_for_clipboard(result)
-    # Serialize to JSON to safely embed in JS string
-    html_json = json.dumps(html_content)
+    # Built once per analysis run and kept next to the result; report_key identifies the run
+    clipboard = st.session_state.get("clipboard_html")
+    if clipboard is None or clipboard[0] != st.session_state.get("report_key"):
+        clipboard = (st.session_state.get("report_key"), generate_html_for_clipboard(result))
+        st.session_state.clipboard_html = clipboard
+    html_content = clipboard[1]
+    # Serialize to JSON to safely embed in JS string (the blob carries every base64 image)
+    html_json = orjson.dumps(html_content).decode()
     
     # Render Custom JS Button
     components.html(f"""